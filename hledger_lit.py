@@ -1,18 +1,38 @@
+import contextlib
+import functools
+import hashlib
+import inspect
+import itertools
 import json
+import marshal
 import os
+import pickle
 import re
 import subprocess
+import tempfile
+import time
 from datetime import datetime, date
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+import numpy as np
+import pandas as pd
 import streamlit as st
+import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from pprint import pformat
 
+# orjson is considerably faster on large reports, but stdlib json (which also accepts bytes) will do
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 # Config file handling
+@functools.lru_cache(maxsize=1)
 def get_config_path():
-    """Get the path to the config file."""
+    """Get the path to the config file, creating its directory on first use."""
     config_home = os.environ.get('XDG_CONFIG_HOME')
     if not config_home:
         config_home = os.path.join(os.path.expanduser('~'), '.config')
@@ -20,14 +40,24 @@ def get_config_path():
     config_dir.mkdir(parents=True, exist_ok=True)
     return config_dir / 'hledger-lit.conf'
 
-def load_config():
-    """Load configuration from config file."""
+# Streamlit reruns the script on every widget change, so the parsed config is kept until the file changes
+@st.cache_data(show_spinner=False)
+def read_config(config_path, mtime_ns):
+    """Parse the config file at config_path. mtime_ns makes the cache notice edits, None means there is no file."""
     config = configparser.ConfigParser()
-    config_path = get_config_path()
-    if config_path.exists():
+    if mtime_ns is not None:
         config.read(config_path)
     return config
 
+def load_config():
+    """Load configuration from config file."""
+    config_path = get_config_path()
+    try:
+        mtime_ns = config_path.stat().st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    return read_config(str(config_path), mtime_ns)
+
 def get_config_value(config, section, key, default):
     """Get a config value with fallback to default."""
     try:
@@ -35,7 +65,7 @@ def get_config_value(config, section, key, default):
     except (configparser.NoSectionError, configparser.NoOptionError):
         return default
 
-def save_config(filename, commodity, income_regex, expense_regex, asset_regex, liability_regex,
+def save_config(filename, commodity, depth, income_regex, expense_regex, asset_regex, liability_regex,
                 historical_cmd, expenses_cmd, income_expenses_cmd, all_flows_cmd):
     """Save current configuration to config file."""
     config = configparser.ConfigParser()
@@ -43,7 +73,8 @@ def save_config(filename, commodity, income_regex, expense_regex, asset_regex, l
     # Create sections
     config['settings'] = {
         'filename': filename,
-        'commodity': commodity
+        'commodity': commodity,
+        'depth': str(depth),
     }
 
     config['regex'] = {
@@ -60,10 +91,12 @@ def save_config(filename, commodity, income_regex, expense_regex, asset_regex, l
         'all_flows': all_flows_cmd,
     }
 
-    # Write to file
+    # Write to a temporary file first, so that an interrupted save can't leave a truncated config behind
     config_path = get_config_path()
-    with open(config_path, 'w') as configfile:
+    tmp_path = config_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as configfile:
         config.write(configfile)
+    tmp_path.replace(config_path)
 
 def reset_config():
     """Delete the config file to reset to defaults."""
@@ -71,78 +104,286 @@ def reset_config():
     if config_path.exists():
         config_path.unlink()
 
+# Report cache handling
+# Entries on disk never expire and every journal edit adds new ones, so only this many of the most recently used are kept
+DISK_CACHE_MAX_ENTRIES = 256
+# Temporary files older than this many seconds are left over from interrupted writes rather than still being written
+DISK_CACHE_TMP_MAX_AGE = 3600
+# Reports kept in memory expire after this many seconds, so that edits to files included by the journal show up
+REPORT_CACHE_TTL = 300
+# Part of every cache key, bumped whenever the layout of cache entries changes
+DISK_CACHE_FORMAT = 3
+
+def disk_cache_enabled():
+    """Whether reports may be cached on disk, which HLEDGER_LIT_DISK_CACHE=0 turns off."""
+    return os.environ.get('HLEDGER_LIT_DISK_CACHE', '1').strip().lower() not in ('0', 'false', 'no', 'off')
+
+@functools.lru_cache(maxsize=1)
+def get_cache_dir():
+    """Get the directory for cached hledger reports, creating it on first use."""
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    cache_dir = Path(cache_home) / 'hledger-lit'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+def prune_cache_dir(cache_dir, max_entries=DISK_CACHE_MAX_ENTRIES):
+    """Remove all but the max_entries most recently used reports from the cache directory.
+
+    Temporary files left behind by writes that were killed halfway are removed as well.
+    """
+    entries = []
+    for path in cache_dir.glob('*.pickle'):
+        # Entries can disappear while we look at them, when several sessions prune at once
+        with contextlib.suppress(OSError):
+            entries.append((path.stat().st_mtime, path))
+    entries.sort(reverse=True)
+    stale = [path for _, path in entries[max_entries:]]
+
+    expired = time.time() - DISK_CACHE_TMP_MAX_AGE
+    for path in cache_dir.glob('*.tmp'):
+        with contextlib.suppress(OSError):
+            if path.stat().st_mtime < expired:
+                stale.append(path)
+
+    for path in stale:
+        with contextlib.suppress(OSError):
+            path.unlink()
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint(func):
+    """Hash the source of func and of every function in this module it calls, directly or through others."""
+    sources = {}
+    pending = [func]
+    while pending:
+        current = inspect.unwrap(pending.pop())
+        if current.__qualname__ in sources:
+            continue
+        try:
+            sources[current.__qualname__] = inspect.getsource(current)
+        except (OSError, TypeError):
+            # Without the source file, the compiled code still changes along with it
+            sources[current.__qualname__] = marshal.dumps(current.__code__)
+        # Names used in nested code, like generator expressions, live in code objects of their own
+        codes = [current.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            for name in code.co_names:
+                value = globals().get(name)
+                if callable(value):
+                    value = inspect.unwrap(value)
+                if inspect.isfunction(value) and value.__module__ == func.__module__:
+                    pending.append(value)
+    return hashlib.sha1(repr(sorted(sources.items())).encode()).hexdigest()
+
+@functools.lru_cache(maxsize=1)
+def hledger_version():
+    """Get the output of hledger --version, or '' if hledger can't be run."""
+    try:
+        process = subprocess.run(['hledger', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return process.stdout.decode(errors='replace').strip()
+
+def disk_cached(func):
+    """Persist results of func in the cache directory, so that they survive restarts of the app.
+
+    Results are keyed on all arguments, which must include journal_mtime so that edits to the journal
+    invalidate them. The key also covers the source code of func and the functions it calls, and the
+    hledger version, so that upgrades of either don't keep returning results computed by the old ones.
+
+    Edits that leave the main journal untouched, like those to included files, are not noticed on disk.
+    Saving the main journal, or clearing the cache directory, makes them show up.
+
+    Financial data ends up in the pickled results, so setting HLEDGER_LIT_DISK_CACHE=0 turns this off.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not disk_cache_enabled():
+            return func(*args, **kwargs)
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = hashlib.sha1(repr((DISK_CACHE_FORMAT, func.__name__, code_fingerprint(func), hledger_version(),
+                                 sorted(arguments.arguments.items()))).encode()).hexdigest()
+        cache_path = get_cache_dir() / f'{key}.pickle'
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                result = pickle.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # Unpickling can fail in many ways, e.g. for entries written by other numpy or pandas versions,
+            # as the cache directory is shared between environments. Such entries are replaced below.
+            with contextlib.suppress(OSError):
+                cache_path.unlink()
+        else:
+            # Mark the entry as recently used, so that pruning keeps it
+            with contextlib.suppress(OSError):
+                os.utime(cache_path)
+            return result
+
+        result = func(*args, **kwargs)
+        tmp_path = None
+        try:
+            # Write to a temporary file first, so that other sessions never read a partial entry
+            with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.tmp', delete=False) as tmp_file:
+                tmp_path = tmp_file.name
+                pickle.dump(result, tmp_file)
+            os.replace(tmp_path, cache_path)
+        except (OSError, pickle.PicklingError):
+            # Don't leave the partial entry behind, e.g. when the disk is full
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.unlink(tmp_path)
+        else:
+            prune_cache_dir(cache_path.parent)
+        return result
+
+    return wrapper
+
+def cached_report(func):
+    """Cache results of func in memory and on disk, keyed on its arguments plus journal_mtime.
+
+    Calls without a known journal_mtime bypass both caches, as edits to the journal would go unnoticed.
+    """
+    signature = inspect.signature(func)
+    # max_entries bounds memory, as every new date range or journal edit adds cache entries
+    cached_func = st.cache_data(ttl=REPORT_CACHE_TTL, max_entries=32, show_spinner=False)(disk_cached(func))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if signature.bind(*args, **kwargs).arguments.get('journal_mtime') is None:
+            return func(*args, **kwargs)
+        return cached_func(*args, **kwargs)
+
+    return wrapper
+
 # Regular expressions for matching account types
 ASSET_REGEX     = 'assets'
 LIABILITY_REGEX = 'liabilities'
 INCOME_REGEX    = 'income|virtual|revenues'
 EXPENSE_REGEX   = 'expenses'
 
+# Default account depth for the treemap and sankey graphs
+DEFAULT_DEPTH = 4
+
 # Default hledger commands for each graph type
-# Available variables: {filename}, {commodity}, {start_date}, {end_date},
+# Available variables: {filename}, {commodity}, {depth}, {start_date}, {end_date},
 #                      {income_regex}, {expense_regex}, {asset_regex}, {liability_regex}, {all_accounts}
 DEFAULT_HISTORICAL_CMD = 'hledger -f {filename} balance {all_accounts} not:tag:clopen --depth 1 --period daily --historical --value=then,{commodity} --infer-value -O json -b {start_date} -e {end_date}'
-DEFAULT_EXPENSES_CMD = 'hledger -f {filename} balance {expense_regex} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide -O json -b {start_date} -e {end_date}'
-DEFAULT_INCOME_EXPENSES_CMD = 'hledger -f {filename} balance {income_regex} {expense_regex} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide -O json -b {start_date} -e {end_date}'
-DEFAULT_ALL_FLOWS_CMD = 'hledger -f {filename} balance {all_accounts} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide -O json -b {start_date} -e {end_date}'
+DEFAULT_EXPENSES_CMD = 'hledger -f {filename} balance {expense_regex} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide --depth {depth} -O json -b {start_date} -e {end_date}'
+DEFAULT_INCOME_EXPENSES_CMD = 'hledger -f {filename} balance {income_regex} {expense_regex} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide --depth {depth} -O json -b {start_date} -e {end_date}'
+DEFAULT_ALL_FLOWS_CMD = 'hledger -f {filename} balance {all_accounts} not:tag:clopen --cost --value=then,{commodity} --infer-value --no-total --tree --no-elide --depth {depth} -O json -b {start_date} -e {end_date}'
+
+# Default commands that only narrow the account query of DEFAULT_ALL_FLOWS_CMD, with the regex variables they keep
+ALL_FLOWS_SUBSETS = {
+    DEFAULT_EXPENSES_CMD: ('expense_regex',),
+    DEFAULT_INCOME_EXPENSES_CMD: ('income_regex', 'expense_regex'),
+}
+
+# Template variables holding space-separated lists of account regexes
+ACCOUNT_REGEX_VARS = ('income_regex', 'expense_regex', 'asset_regex', 'liability_regex', 'all_accounts')
+
+def expand_command(template, cmd_vars):
+    """Expand a command template into the argument list for hledger.
+
+    Template words are formatted one by one, so values with spaces (like file names) stay a single argument,
+    while a word consisting of just an account regex variable becomes one argument per regex.
+    """
+    args = []
+    for word in template.split():
+        if word.startswith('{') and word.endswith('}') and word[1:-1] in ACCOUNT_REGEX_VARS:
+            args.extend(cmd_vars[word[1:-1]].split())
+        else:
+            args.append(word.format(**cmd_vars))
+    return args
 
 
 # assets:cash -> assets
 # assets -> ''
+# The same account names show up in every report, so parents are memoized
+@functools.lru_cache(maxsize=4096)
 def parent(account_name):
-    return ':'.join(account_name.split(':')[:-1])
-
-def run_hledger_command(command):
-    """Execute hledger command and return parsed JSON output."""
-    process_output = subprocess.run(command.split(' '), stdout=subprocess.PIPE, text=True).stdout
-    return json.loads(process_output)
-
-def run_historical_command(command, commodity, asset_regex, liability_regex):
-    """Run a custom hledger command and parse historical balances."""
-    data = run_hledger_command(command)
-
-    # Extract dates from prDates - use the start date of each period
-    dates = [period[0]['contents'] for period in data['prDates']]
-    num_periods = len(dates)
-
-    # Compile regex patterns for matching
-    asset_pattern = re.compile('|'.join(asset_regex.split()))
-    liability_pattern = re.compile('|'.join(liability_regex.split()))
-
-    # Initialize net worth tracking
-    net_worth = [0.0] * num_periods
-
-    # Extract balances for each account
-    balances = {}
-    for row in data['prRows']:
-        account_name = row['prrName']
-        # Extract floating point values from each period and apply abs()
-        account_balances = []
-        for amount_list in row['prrAmounts']:
-            balance = 0
-            if amount_list:
-                # Find the amount matching the desired commodity
-                for amount in amount_list:
-                    if amount['acommodity'] == commodity:
-                        balance = abs(amount['aquantity']['floatingPoint'])
-                        break
-            account_balances.append(balance)
-        balances[account_name] = account_balances
-
-        # Update net worth: add assets, subtract liabilities
-        if asset_pattern.search(account_name):
-            net_worth = [nw + bal for nw, bal in zip(net_worth, account_balances)]
-        elif liability_pattern.search(account_name):
-            net_worth = [nw - bal for nw, bal in zip(net_worth, account_balances)]
-
-    # Add net worth to balances
+    return account_name.rpartition(':')[0]
+
+@functools.lru_cache(maxsize=64)
+def compile_account_regex(account_regex):
+    """Compile space-separated account regexes into a single pattern, reused across reruns."""
+    return re.compile('|'.join(account_regex.split()))
+
+def run_hledger_command(args):
+    """Execute hledger with the given argument list and return parsed JSON output."""
+    # A failing hledger usually leaves empty or truncated output, so its exit status is checked before parsing.
+    # Its error message goes to stderr, which is kept for the CalledProcessError shown in the UI.
+    process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    # Parse the raw bytes, which also skips decoding the output to str first
+    return json_loads(process.stdout)
+
+def account_mask(names, account_regex):
+    """Match a Series of account names against space-separated account regexes."""
+    patterns = [pattern for word in account_regex.split() for pattern in word.split('|')]
+    if patterns and all(re.escape(pattern) == pattern for pattern in patterns):
+        # Plain names like 'assets' only need a substring search, which is cheaper than running a regex
+        mask = np.zeros(len(names), dtype=bool)
+        for pattern in patterns:
+            mask |= names.str.contains(pattern, regex=False).to_numpy(dtype=bool)
+        return mask
+    return names.str.contains(compile_account_regex(account_regex)).to_numpy(dtype=bool)
+
+def commodity_quantity(amount_list, commodity):
+    """Get the quantity of the amount in commodity from an hledger amount list, or 0 if there is none."""
+    # With --value=then,{commodity} the list usually holds a single amount, already in the desired commodity
+    if amount_list and amount_list[0]['acommodity'] == commodity:
+        return amount_list[0]['aquantity']['floatingPoint']
+    for amount in amount_list:
+        if amount['acommodity'] == commodity:
+            return amount['aquantity']['floatingPoint']
+    return 0
+
+def parse_historical_report(report, commodity, asset_regex, liability_regex):
+    """Turn a periodic hledger balance report into per-account balances and net worth."""
+    # Use the start date of each period
+    dates = [period[0]['contents'] for period in report['prDates']]
+    names = []
+    amounts = []
+    for row in report['prRows']:
+        # Extract floating point values from each period
+        names.append(row['prrName'])
+        amount_lists = row['prrAmounts']
+        amounts.append(np.fromiter((commodity_quantity(amount_list, commodity) for amount_list in amount_lists),
+                                   dtype=np.float64, count=len(amount_lists)))
+
+    names = pd.Series(names, dtype=object)
+    # abs() is applied to the whole matrix at once
+    amounts = np.abs(np.array(amounts, dtype=np.float64).reshape(len(names), len(dates)))
+
+    # Net worth: add assets, subtract liabilities
+    asset_mask = account_mask(names, asset_regex)
+    liability_mask = account_mask(names, liability_regex) & ~asset_mask
+    net_worth = amounts[asset_mask].sum(axis=0) - amounts[liability_mask].sum(axis=0)
+
+    balances = dict(zip(names, amounts))
     balances['net_worth'] = net_worth
 
     return {'dates': dates, 'balances': balances}
 
-def read_current_balances(command):
+# Reports are cached on their arguments plus the mtime and size of the journal, so unchanged inputs don't re-run hledger.
+# They are also persisted to disk, so restarting the app doesn't re-run hledger either.
+@cached_report
+def run_historical_command(args, commodity, asset_regex, liability_regex, journal_mtime=None):
+    """Run a custom hledger command and parse historical balances."""
+    report = run_hledger_command(args)
+    return parse_historical_report(report, commodity, asset_regex, liability_regex)
+
+@cached_report
+def read_current_balances(args, journal_mtime=None):
     """Execute hledger command and parse current balances from JSON output."""
     # Execute command and parse JSON output
-    data = run_hledger_command(command)
+    data = run_hledger_command(args)
 
     # First element of the JSON array contains the account entries
     accounts = data[0]
@@ -161,64 +402,99 @@ def read_current_balances(command):
 
     return balances
 
+@cached_report
 def read_historical_balances(filename, commodity, start_date=None, end_date=None,
                             income_regex=INCOME_REGEX, expense_regex=EXPENSE_REGEX,
-                            asset_regex=ASSET_REGEX, liability_regex=LIABILITY_REGEX):
+                            asset_regex=ASSET_REGEX, liability_regex=LIABILITY_REGEX, journal_mtime=None):
     """Read historical daily cumulative balances for accounts matching regex patterns."""
     # Build list of account regex patterns
     account_categories = ' '.join([income_regex, expense_regex, asset_regex, liability_regex])
-    command = f'hledger -f {filename} balance {account_categories} not:tag:clopen --depth 1 --period daily --historical --value=then,{commodity} --infer-value -O json'
+    args = ['hledger', '-f', filename, 'balance', *account_categories.split(), 'not:tag:clopen', '--depth', '1',
+            '--period', 'daily', '--historical', f'--value=then,{commodity}', '--infer-value', '-O', 'json']
 
     # Add date range if provided
     if start_date:
-        command += f' -b {start_date}'
+        args += ['-b', str(start_date)]
     if end_date:
-        command += f' -e {end_date}'
+        args += ['-e', str(end_date)]
 
-    # Execute command and parse JSON output
-    data = run_hledger_command(command)
-
-    # Extract dates from prDates - use the start date of each period
-    dates = [period[0]['contents'] for period in data['prDates']]
-    num_periods = len(dates)
-
-    # Compile regex patterns for matching
-    account_patterns = re.compile('|'.join(account_categories.split()))
-    asset_pattern = re.compile('|'.join(asset_regex.split()))
-    liability_pattern = re.compile('|'.join(liability_regex.split()))
-
-    # Initialize net worth tracking
-    net_worth = [0.0] * num_periods
-
-    # Extract balances for each account
-    balances = {}
-    for row in data['prRows']:
-        account_name = row['prrName']
-        # Only include accounts that match our regex patterns
-        if account_patterns.search(account_name):
-            # Extract floating point values from each period and apply abs()
-            account_balances = []
-            for amount_list in row['prrAmounts']:
-                balance = 0
-                if amount_list:
-                    # Find the amount matching the desired commodity
-                    for amount in amount_list:
-                        if amount['acommodity'] == commodity:
-                            balance = abs(amount['aquantity']['floatingPoint'])
-                            break
-                account_balances.append(balance)
-            balances[account_name] = account_balances
-
-            # Update net worth: add assets, subtract liabilities
-            if asset_pattern.search(account_name):
-                net_worth = [nw + bal for nw, bal in zip(net_worth, account_balances)]
-            elif liability_pattern.search(account_name):
-                net_worth = [nw - bal for nw, bal in zip(net_worth, account_balances)]
-
-    # Add net worth to balances
-    balances['net_worth'] = net_worth
+    # Execute command and parse JSON output.
+    # hledger only reports accounts matching account_categories, so there's no need to filter them again
+    report = run_hledger_command(args)
 
-    return {'dates': dates, 'balances': balances}
+    return parse_historical_report(report, commodity, asset_regex, liability_regex)
+
+def get_journal_mtime(filename):
+    """Get the modification time and size of the journal file, or None if it can't be read.
+
+    Only the main journal is checked, not the files it includes, CSV rules files or files named in custom commands.
+    """
+    try:
+        # hledger expands ~ in the journal path itself
+        journal_stat = os.stat(os.path.expanduser(filename))
+    except OSError:
+        return None
+    return journal_stat.st_mtime_ns, journal_stat.st_size
+
+# hledger query terms with one of these prefixes match something other than a plain account name regex
+QUERY_PREFIX = re.compile(r'^(not|acct|amt|code|cur|date|date2|depth|desc|expr|inacct|inacctonly|note|payee|real|status|tag|type):')
+
+def is_account_regex(account_regex):
+    """Check that every space-separated term of account_regex is a bare account regex, not some other hledger query."""
+    return not any(QUERY_PREFIX.match(term) or term.startswith('-') for term in account_regex.split())
+
+def filter_account_subtrees(balances, account_regex):
+    """Keep balances of accounts matching account_regex, like narrowing the hledger account query would.
+
+    This is only equivalent when account_regex consists of bare account regexes and the matching accounts
+    form whole top-level subtrees. Otherwise hledger's result would differ, and None is returned.
+    """
+    if not is_account_regex(account_regex):
+        return None
+    try:
+        # hledger account queries are case-insensitive
+        pattern = re.compile('|'.join(account_regex.split()), re.IGNORECASE)
+    except re.error:
+        return None
+    matches = {account_name: bool(pattern.search(account_name)) for account_name, _ in balances}
+    if any(match != matches.get(account_name.split(':', 1)[0]) for account_name, match in matches.items()):
+        return None
+    return [(account_name, balance) for account_name, balance in balances if matches[account_name]]
+
+def fetch_all(historical_cmd, expenses_cmd, income_expenses_cmd, all_flows_cmd, cmd_vars, journal_mtime):
+    """Run hledger commands for all graphs concurrently and return their parsed reports."""
+    # hledger is single-threaded, so independent invocations can use separate cores
+    with ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as executor:
+        def submit_balances(template):
+            return executor.submit(read_current_balances, expand_command(template, cmd_vars), journal_mtime)
+
+        futures = {
+            'historical': executor.submit(run_historical_command, expand_command(historical_cmd, cmd_vars), cmd_vars['commodity'],
+                                          cmd_vars['asset_regex'], cmd_vars['liability_regex'], journal_mtime),
+            'all_flows': submit_balances(all_flows_cmd),
+        }
+
+        # Reports that only narrow the account query of the all flows report are filtered out of it,
+        # which saves hledger parsing the journal again. Query terms like desc: or not: would make the
+        # reports differ in other ways, so then every report runs its own command.
+        subsets = {}
+        derive_subsets = all_flows_cmd == DEFAULT_ALL_FLOWS_CMD and is_account_regex(cmd_vars['all_accounts'])
+        for key, template in (('expenses', expenses_cmd), ('income_expenses', income_expenses_cmd)):
+            if derive_subsets and template in ALL_FLOWS_SUBSETS:
+                subsets[key] = template
+            else:
+                futures[key] = submit_balances(template)
+
+        reports = {}
+        for key, template in subsets.items():
+            account_regex = ' '.join(cmd_vars[var] for var in ALL_FLOWS_SUBSETS[template])
+            reports[key] = filter_account_subtrees(futures['all_flows'].result(), account_regex)
+            if reports[key] is None:
+                futures[key] = submit_balances(template)
+
+        reports.update((key, future.result()) for key, future in futures.items())
+
+    return reports
 
 # Convert hledger balance report into a list of (source, target, value) tuples for the sankey graph.
 # We make the following assumptions:
@@ -227,56 +503,52 @@ def read_historical_balances(filename, commodity, start_date=None, end_date=None
 # 2. For sankey diagram, we want to see how "income" is being used to cover "expenses", increas the value of "assets" and pay off "liabilities", so we assume that
 #    by default the money are flowing from income to the other categores.
 # 3. However, positive income or negative expenses/assets/liabilities would be correctly treated as money flowing against the "usual" direction
-def to_sankey_data(balances, income_regex=INCOME_REGEX, expense_regex=EXPENSE_REGEX,
-                   asset_regex=ASSET_REGEX, liability_regex=LIABILITY_REGEX):
+@st.cache_data(show_spinner=False)
+def to_sankey_data(balances):
     # List to store (source, target, value) tuples
     sankey_data = []
 
-    # A set of all accounts mentioned in the report, to check that parent accounts have known balance
-    accounts = set(account_name for account_name, _ in balances)
-
-    # Compile regex pattern for income matching
-    income_pattern = re.compile('|'.join(income_regex.split()))
+    # Parents of all accounts mentioned in the report, also used to check that parent accounts have known balance.
+    # top-level accounts need to be connected to the special "pot" intermediate bucket
+    parent_of = {account_name: account_name.rpartition(':')[0] or 'pot' for account_name, _ in balances}
 
     # Convert report to sankey data
     for account_name, balance in balances:
-        # top-level accounts need to be connected to the special "pot" intermediate bucket
-        # We assume that income accounts (including virtual, revenues) contribute to pot, while expenses draw from it
-        if ':' not in account_name:
-            parent_acc = 'pot'
-        else:
-            parent_acc = parent(account_name)
-            if parent_acc not in accounts:
-                raise Exception(f'for account {account_name}, parent account {parent_acc} not found - have you forgotten --no-elide?')
-
-        # income accounts flow 'up'
-        if income_pattern.search(account_name):
-            # Negative income is just income, positive income is a reduction, pay-back or something similar
-            # For sankey, all flow values should be positive
-            if balance < 0:
-                source, target = account_name, parent_acc
-            else:
-                source, target = parent_acc, account_name
+        parent_acc = parent_of[account_name]
+        if parent_acc != 'pot' and parent_acc not in parent_of:
+            raise Exception(f'for account {account_name}, parent account {parent_acc} not found - have you forgotten --no-elide?')
+
+        # Negative balances flow 'up' into their parent: that is just income (including virtual, revenues), or
+        # cashbacks and cashing in of investments. Positive balances are expenses, investments or purchase of
+        # assets, or reductions/pay-backs of income, and flow 'down' from the parent.
+        # For sankey, all flow values should be positive
+        if balance < 0:
+            source, target = account_name, parent_acc
         else:
-            # positive expenses/assets are normal expenses or investements or purchase of assets, negative values are cashbacks, or cashing in of investments
-            if balance >= 0:
-                source, target = parent_acc, account_name
-            else:
-                source, target = account_name, parent_acc
+            source, target = parent_acc, account_name
 
         sankey_data.append((source, target, abs(balance)))
 
     return sankey_data
 
+# Plots are cached on their input data. They are returned as go.Figure objects, because st.plotly_chart rebuilds
+# and validates a figure from a dict on every render, which is slow for the large historical chart.
+# cache_resource hands back the cached figure itself rather than an unpickled copy, which is safe as
+# plotly_chart only reads it. max_entries bounds memory like for the reports.
+@st.cache_resource(max_entries=32, show_spinner=False)
 def sankey_plot(sankey_data):
     # Sort by (target, source) to keep related accounts close together in the initial layout
-    sankey_data = sorted(sankey_data, key=lambda x: (x[1], x[0]))
-
-    # Get unique node names
-    nodes = list(dict.fromkeys(
-        [source for source, _, _ in sankey_data] +
-        [target for _, target, _ in sankey_data]
-    ))
+    sources, targets, values = [], [], []
+    for source, target, value in sorted(sankey_data, key=lambda x: (x[1], x[0])):
+        sources.append(source)
+        targets.append(target)
+        values.append(float(value))
+
+    # Get unique node names, numbered in order of first appearance
+    node_index = {}
+    for node in itertools.chain(sources, targets):
+        node_index.setdefault(node, len(node_index))
+    nodes = list(node_index)
 
     # Create Sankey diagram
     fig = go.Figure(data=[go.Sankey(
@@ -288,18 +560,21 @@ def sankey_plot(sankey_data):
             color="blue"
         ),
         link=dict(
-            source=[nodes.index(source) for source, _, _ in sankey_data],
-            target=[nodes.index(target) for _, target, _ in sankey_data],
-            value=[value for _, _, value in sankey_data]
+            source=[node_index[source] for source in sources],
+            target=[node_index[target] for target in targets],
+            value=values
         ))])
 
     return fig
 
+@st.cache_resource(max_entries=32, show_spinner=False)
 def expenses_treemap_plot(balances):
     # balances already contains only expenses
-    labels = [name for name, _ in balances]
-    values = [value for _, value in balances]
-    parents = [parent(name) for name, _ in balances]
+    labels, values, parents = [], [], []
+    for name, value in balances:
+        labels.append(name)
+        values.append(value)
+        parents.append(parent(name))
 
     fig = go.Figure(go.Treemap(
         labels=labels,
@@ -310,38 +585,30 @@ def expenses_treemap_plot(balances):
 
     return fig
 
+@st.cache_resource(max_entries=32, show_spinner=False)
 def historical_balances_plot(historical_data):
     """Create line chart showing historical balances for each account category plus net worth."""
     dates = historical_data['dates']
     balances = historical_data['balances']
 
-    fig = go.Figure()
+    # One column per account category, with net worth added separately at the end
+    columns = sorted(name for name in balances if name != 'net_worth')
+    if 'net_worth' in balances:
+        columns.append('net_worth')
+    df = pd.DataFrame({name: balances[name] for name in columns}, index=pd.to_datetime(dates))
 
-    # Add traces for each account category
-    for account_name in sorted(balances.keys()):
-        if account_name != 'net_worth':  # We'll add net worth separately at the end
-            fig.add_trace(go.Scatter(
-                x=dates,
-                y=balances[account_name],
-                mode='lines',
-                name=account_name
-            ))
+    # Build all traces in one go rather than appending them one by one.
+    # Daily balances over years are thousands of points per line, which WebGL draws much faster than SVG
+    fig = px.line(df, log_y=True, render_mode='webgl', title="Historical Account Balances")
+    fig.update_traces(hovertemplate=None)
 
-    # Add net worth as a separate line with emphasis
-    if 'net_worth' in balances:
-        fig.add_trace(go.Scatter(
-            x=dates,
-            y=balances['net_worth'],
-            mode='lines',
-            name='net_worth',
-            line=dict(width=3, dash='dash')
-        ))
+    # Emphasize net worth
+    fig.update_traces(selector={'name': 'net_worth'}, line=dict(width=3, dash='dash'))
 
     fig.update_layout(
-        title="Historical Account Balances",
         xaxis_title="Date",
         yaxis_title="Balance (log scale)",
-        yaxis_type="log",
+        legend_title_text=None,
         hovermode='x unified'
     )
 
@@ -364,6 +631,13 @@ with st.sidebar:
     # Get default values from config with fallbacks
     default_filename = get_config_value(config, 'settings', 'filename', os.environ.get('LEDGER_FILE', ''))
     default_commodity = get_config_value(config, 'settings', 'commodity', '£')
+    # A hand-edited config may hold anything here, which must not stop the sidebar (and its reset button) from showing
+    try:
+        default_depth = int(get_config_value(config, 'settings', 'depth', DEFAULT_DEPTH))
+    except ValueError:
+        default_depth = DEFAULT_DEPTH
+    if default_depth < 1:
+        default_depth = DEFAULT_DEPTH
 
     filename = st.text_input(
         "HLedger Journal File Path",
@@ -377,6 +651,14 @@ with st.sidebar:
         help="Commodity to convert all values to (via -value=then,{commodity})"
     )
 
+    depth = st.number_input(
+        "Max Account Depth",
+        min_value=1,
+        value=default_depth,
+        step=1,
+        help="Deepest account level shown in the treemap and flow graphs (via --depth {depth}). Lower values make large journals faster"
+    )
+
     # Date range inputs
     current_year = date.today().year
     start_date = st.date_input(
@@ -435,7 +717,7 @@ with st.sidebar:
     )
 
     st.subheader("Command Templates")
-    st.caption("Available variables: {filename}, {commodity}, {start_date}, {end_date}, {income_regex}, {expense_regex}, {asset_regex}, {liability_regex}, {all_accounts}")
+    st.caption("Available variables: {filename}, {commodity}, {depth}, {start_date}, {end_date}, {income_regex}, {expense_regex}, {asset_regex}, {liability_regex}, {all_accounts}")
 
     with st.expander("Historical Balances Command", expanded=False):
         historical_cmd = st.text_area(
@@ -471,7 +753,7 @@ with st.sidebar:
 
 # Handle Save Config button
 if save_config_button:
-    save_config(filename, commodity, income_regex, expense_regex, asset_regex, liability_regex,
+    save_config(filename, commodity, depth, income_regex, expense_regex, asset_regex, liability_regex,
                 historical_cmd, expenses_cmd, income_expenses_cmd, all_flows_cmd)
     st.success(f"Configuration saved to {get_config_path()}")
 
@@ -500,6 +782,7 @@ all_accounts = f"{income_regex} {expense_regex} {asset_regex} {liability_regex}"
 cmd_vars = {
     'filename': filename,
     'commodity': commodity,
+    'depth': depth,
     'start_date': start_date,
     'end_date': end_date,
     'income_regex': income_regex,
@@ -508,6 +791,29 @@ cmd_vars = {
     'liability_regex': liability_regex,
     'all_accounts': all_accounts,
 }
+journal_mtime = get_journal_mtime(filename)
+
+generate_all = st.button("Generate All", key="gen_all")
+
+if generate_all:
+    try:
+        with st.spinner("Generating all graphs..."):
+            reports = fetch_all(historical_cmd, expenses_cmd, income_expenses_cmd, all_flows_cmd, cmd_vars, journal_mtime)
+            st.session_state.historical_fig = historical_balances_plot(reports['historical'])
+            st.session_state.expenses_fig = expenses_treemap_plot(reports['expenses'])
+            income_expenses_sankey = to_sankey_data(reports['income_expenses'])
+            st.session_state.income_expenses_fig = sankey_plot(income_expenses_sankey)
+            all_balances_sankey = to_sankey_data(reports['all_flows'])
+            st.session_state.all_balances_fig = sankey_plot(all_balances_sankey)
+    except subprocess.CalledProcessError as e:
+        st.error(f"Error running hledger command: {e}\n\n{e.stderr.decode(errors='replace')}")
+    except json.JSONDecodeError as e:
+        st.error(f"Error parsing JSON output: {e}")
+    except Exception as e:
+        st.error(f"Error: {e}")
+        st.exception(e)
+
+st.divider()
 
 # Historical Account Balances
 st.header("Historical Account Balances")
@@ -519,11 +825,11 @@ if generate_historical:
     try:
         with st.spinner("Generating historical balances..."):
             # Expand command template with variables
-            expanded_cmd = historical_cmd.format(**cmd_vars)
-            historical_data = run_historical_command(expanded_cmd, commodity, asset_regex, liability_regex)
+            expanded_cmd = expand_command(historical_cmd, cmd_vars)
+            historical_data = run_historical_command(expanded_cmd, commodity, asset_regex, liability_regex, journal_mtime)
             st.session_state.historical_fig = historical_balances_plot(historical_data)
     except subprocess.CalledProcessError as e:
-        st.error(f"Error running hledger command: {e}")
+        st.error(f"Error running hledger command: {e}\n\n{e.stderr.decode(errors='replace')}")
     except json.JSONDecodeError as e:
         st.error(f"Error parsing JSON output: {e}")
     except Exception as e:
@@ -544,11 +850,11 @@ if generate_treemap:
     try:
         with st.spinner("Generating expenses treemap..."):
             # Expand command template with variables
-            expanded_cmd = expenses_cmd.format(**cmd_vars)
-            expenses = read_current_balances(expanded_cmd)
+            expanded_cmd = expand_command(expenses_cmd, cmd_vars)
+            expenses = read_current_balances(expanded_cmd, journal_mtime)
             st.session_state.expenses_fig = expenses_treemap_plot(expenses)
     except subprocess.CalledProcessError as e:
-        st.error(f"Error running hledger command: {e}")
+        st.error(f"Error running hledger command: {e}\n\n{e.stderr.decode(errors='replace')}")
     except json.JSONDecodeError as e:
         st.error(f"Error parsing JSON output: {e}")
     except Exception as e:
@@ -569,12 +875,12 @@ if generate_income_expenses:
     try:
         with st.spinner("Generating income & expenses flows..."):
             # Expand command template with variables
-            expanded_cmd = income_expenses_cmd.format(**cmd_vars)
-            income_expenses = read_current_balances(expanded_cmd)
-            income_expenses_sankey = to_sankey_data(income_expenses, income_regex, expense_regex, asset_regex, liability_regex)
+            expanded_cmd = expand_command(income_expenses_cmd, cmd_vars)
+            income_expenses = read_current_balances(expanded_cmd, journal_mtime)
+            income_expenses_sankey = to_sankey_data(income_expenses)
             st.session_state.income_expenses_fig = sankey_plot(income_expenses_sankey)
     except subprocess.CalledProcessError as e:
-        st.error(f"Error running hledger command: {e}")
+        st.error(f"Error running hledger command: {e}\n\n{e.stderr.decode(errors='replace')}")
     except json.JSONDecodeError as e:
         st.error(f"Error parsing JSON output: {e}")
     except Exception as e:
@@ -595,12 +901,12 @@ if generate_all_flows:
     try:
         with st.spinner("Generating all cash flows..."):
             # Expand command template with variables
-            expanded_cmd = all_flows_cmd.format(**cmd_vars)
-            all_balances = read_current_balances(expanded_cmd)
-            all_balances_sankey = to_sankey_data(all_balances, income_regex, expense_regex, asset_regex, liability_regex)
+            expanded_cmd = expand_command(all_flows_cmd, cmd_vars)
+            all_balances = read_current_balances(expanded_cmd, journal_mtime)
+            all_balances_sankey = to_sankey_data(all_balances)
             st.session_state.all_balances_fig = sankey_plot(all_balances_sankey)
     except subprocess.CalledProcessError as e:
-        st.error(f"Error running hledger command: {e}")
+        st.error(f"Error running hledger command: {e}\n\n{e.stderr.decode(errors='replace')}")
     except json.JSONDecodeError as e:
         st.error(f"Error parsing JSON output: {e}")
     except Exception as e: